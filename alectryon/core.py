@@ -20,8 +20,11 @@
 
 from typing import Any, Dict, DefaultDict, Iterator, List, Tuple, Union, NamedTuple
 
+from array import array
+from bisect import bisect_left
 from collections import namedtuple, defaultdict
 from contextlib import contextmanager
+from functools import lru_cache
 from shlex import quote
 from shutil import which
 from subprocess import Popen, PIPE, check_output
@@ -39,11 +42,14 @@ TRACEBACK = False
 class UnexpectedError(ValueError):
     pass
 
+NONEMPTY_LINE_RE = re.compile("^(?!$)", re.MULTILINE)
+EMPTY_LINE_RE = re.compile("^$", re.MULTILINE)
+
 def indent(text, prefix):
     if prefix.isspace():
         return textwrap.indent(text, prefix)
-    text = re.sub("^(?!$)", prefix, text, flags=re.MULTILINE)
-    return re.sub("^$", prefix.rstrip(), text, flags=re.MULTILINE)
+    text = NONEMPTY_LINE_RE.sub(prefix, text)
+    return EMPTY_LINE_RE.sub(prefix.rstrip(), text)
 
 def debug(text, prefix):
     if isinstance(text, (bytes, bytearray)):
@@ -51,9 +57,13 @@ def debug(text, prefix):
     if DEBUG:
         print(indent(text.rstrip(), prefix), flush=True)
 
+@lru_cache(maxsize=None)
+def _fmt_generator(name, version, include_version_info):
+    return "{} v{}".format(name, version) if include_version_info else name
+
 class GeneratorInfo(namedtuple("GeneratorInfo", "name version")):
     def fmt(self, include_version_info=True):
-        return "{} v{}".format(self.name, self.version) if include_version_info else self.name
+        return _fmt_generator(self.name, self.version, include_version_info)
 
 Hypothesis = namedtuple("Hypothesis", "names body type")
 Goal = namedtuple("Goal", "name conclusion hypotheses")
@@ -62,21 +72,56 @@ Sentence = namedtuple("Sentence", "contents messages goals")
 Text = namedtuple("Text", "contents")
 
 class Enriched():
+    """Base class for ``Rich*`` types.
+
+    Instances behave like the namedtuples that they enrich (iteration,
+    ``_fields``, ``_replace``, pickling), but they use ``__slots__`` for
+    faster construction and attribute access.
+    """
     __slots__ = ()
-    def __new__(cls, *args, **kwargs):
-        if len(args) < len(getattr(super(), "_fields", ())):
-            # Don't repeat fields given by position (it breaks pickle & deepcopy)
-            kwargs = {"ids": [], "markers": [], "props": {}, **kwargs}
-        return super().__new__(cls, *args, **kwargs)
+    _fields: Tuple[str, ...] = ()
+
+    def __iter__(self):
+        return (getattr(self, f) for f in self._fields)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and tuple(self) == tuple(other)
+
+    __hash__ = None # type: ignore
+
+    def __reduce__(self):
+        return (type(self), tuple(self))
+
+    def __repr__(self):
+        fields = ", ".join("{}={!r}".format(f, v) for f, v in zip(self._fields, self))
+        return "{}({})".format(type(self).__name__, fields)
+
+    def _replace(self, **kwargs):
+        obj = type(self)(*(kwargs.pop(f, v) for f, v in zip(self._fields, self)))
+        if kwargs:
+            raise ValueError("Got unexpected field names: {}".format(list(kwargs)))
+        return obj
+
+ENRICHED_INIT = """\
+def __init__(self, {fields}, ids=None, markers=None, props=None):
+{assignments}
+    self.ids = [] if ids is None else ids
+    self.markers = [] if markers is None else markers
+    self.props = {{}} if props is None else props
+"""
 
 def _enrich(nt):
-    # LATER: Use dataclass + multiple inheritance; change `ids` and `markers` to
-    # mutable `id` and `marker` fields.
+    # LATER: Use dataclass(slots=True) + inheritance; change `ids` and `markers`
+    # to mutable `id` and `marker` fields.
     name = "Rich" + nt.__name__
     fields = nt._fields + ("ids", "markers", "props")
+    assignments = "\n".join("    self.{0} = {0}".format(f) for f in nt._fields)
+    ns: Dict[str, Any] = {}
+    exec(ENRICHED_INIT.format(fields=", ".join(nt._fields), # pylint: disable=exec-used
+                              assignments=assignments), ns)
     # Using ``type`` this way ensures compatibility with pickling
-    return type(name, (Enriched, namedtuple(name, fields)),
-                {"__slots__": ()})
+    return type(name, (Enriched,),
+                {"__slots__": fields, "_fields": fields, "__init__": ns["__init__"]})
 
 Goals = namedtuple("Goals", "goals")
 Messages = namedtuple("Messages", "messages")
@@ -101,8 +146,9 @@ class Gensym():
         self.counters = self.GENSYM_COUNTERS.setdefault(stem, defaultdict(lambda: -1))
 
     def __call__(self, prefix):
-        self.counters[prefix] += 1
-        return self.stem + prefix + b16(self.counters[prefix])
+        counters = self.counters
+        n = counters[prefix] = counters[prefix] + 1
+        return self.stem + prefix + b16(n)
 
 @contextmanager
 def nullctx():
@@ -111,6 +157,16 @@ def nullctx():
 class Backend:
     def __init__(self, highlighter):
         self.highlighter = highlighter
+        self._dispatch_table = {
+            Text: self.gen_fragment,
+            RichSentence: self.gen_fragment,
+            RichHypothesis: self.gen_hyp,
+            RichGoal: self.gen_goal,
+            RichMessage: self.gen_message,
+            RichCode: self.gen_code,
+            Names: self.gen_names,
+            str: self.gen_txt,
+        }
 
     def gen_fragment(self, fr): raise NotImplementedError()
     def gen_hyp(self, hyp): raise NotImplementedError()
@@ -127,22 +183,13 @@ class Backend:
             return self.highlight(obj.contents)
 
     def _gen_any(self, obj):
-        if isinstance(obj, (Text, RichSentence)):
-            self.gen_fragment(obj)
-        elif isinstance(obj, RichHypothesis):
-            self.gen_hyp(obj)
-        elif isinstance(obj, RichGoal):
-            self.gen_goal(obj)
-        elif isinstance(obj, RichMessage):
-            self.gen_message(obj)
-        elif isinstance(obj, RichCode):
-            self.gen_code(obj)
-        elif isinstance(obj, Names):
-            self.gen_names(obj)
-        elif isinstance(obj, str):
-            self.gen_txt(obj)
-        else:
+        handler = self._dispatch_table.get(type(obj))
+        if handler is None: # Subclasses of the types above
+            handler = next((h for typ, h in self._dispatch_table.items()
+                            if isinstance(obj, typ)), None)
+        if handler is None:
             raise TypeError("Unexpected object type: {}".format(type(obj)))
+        handler(obj)
 
 class Asset(str):
     def __new__(cls, fname, _gen):
@@ -182,6 +229,7 @@ class View(bytes):
 
 class PosView(View):
     NL = b"\n"
+    NON_ASCII_RE = re.compile(rb"[^\x00-\x7f]")
 
     def __new__(cls, s):
         bs = s.encode("utf-8")
@@ -191,9 +239,19 @@ class PosView(View):
     def __init__(self, s):
         super().__init__(s)
         self.pos, self.col_offset = s.pos, s.col_offset
+        self._nl_offsets = None
 
-    def __getitem__(self, key):
-        return memoryview(self).__getitem__(key)
+    @property
+    def nl_offsets(self):
+        """Offsets of all newlines, to translate offsets in logarithmic time.
+
+        Offsets are only translated when reporting errors, so this list is
+        computed on first use.
+        """
+        if self._nl_offsets is None:
+            # An array uses 8 bytes per newline, vs. ~36 for a list of ints
+            self._nl_offsets = array('q', (m.start() for m in re.finditer(self.NL, self)))
+        return self._nl_offsets
 
     def translate_offset(self, offset):
         r"""Translate a character-based `offset` into a (line, column) pair.
@@ -205,14 +263,23 @@ class PosView(View):
         Position(fpath='f', line=3, col=2)
         >>> s.translate_offset(10) # col=3, + offset (5) = 8
         Position(fpath='f', line=5, col=8)
+        >>> s.translate_offset(4) # Just past the first newline
+        Position(fpath='f', line=4, col=6)
+        >>> s = PosView(PosStr("a\nβγd", Position("f", 1, 1), 0))
+        >>> s.translate_offset(6) # Columns count characters, not bytes
+        Position(fpath='f', line=2, col=3)
         """
-        nl = self.rfind(self.NL, 0, offset)
-        if nl == -1: # First line
+        nlines = bisect_left(self.nl_offsets, offset)
+        if nlines == 0: # First line
             line, col = self.pos.line, self.pos.col + offset
         else:
-            line = self.pos.line + self.count(self.NL, 0, offset)
-            prefix = bytes(self[nl+1:offset]).decode("utf-8", 'ignore')
-            col = 1 + self.col_offset + len(prefix)
+            nl = self.nl_offsets[nlines - 1]
+            line = self.pos.line + nlines
+            if self.NON_ASCII_RE.search(self, nl + 1, offset):
+                ncols = len(bytes(self[nl+1:offset]).decode("utf-8", 'ignore'))
+            else: # Fast path: one byte per character
+                ncols = offset - (nl + 1)
+            col = 1 + self.col_offset + ncols
         return Position(self.pos.fpath, line, col)
 
     def translate_span(self, beg, end):
@@ -243,7 +310,13 @@ class StderrObserver(Observer):
         level_name = {2: "WARNING", 3: "ERROR"}.get(n.level, "??")
         sys.stderr.write("{} ({}/{}) {}\n".format(header, level_name, n.level, message))
 
-PrettyPrinted = namedtuple("PrettyPrinted", "sid pp")
+# The following are plain classes with ``__slots__`` rather than namedtuples
+# because they are created for each of sertop's responses and never unpacked.
+
+class PrettyPrinted:
+    __slots__ = ("sid", "pp")
+    def __init__(self, sid, pp):
+        self.sid, self.pp = sid, pp
 
 def sexp_hd(sexp):
     if isinstance(sexp, list):
@@ -255,12 +328,29 @@ def utf8(x):
 
 ApiAck = namedtuple("ApiAck", "")
 ApiCompleted = namedtuple("ApiCompleted", "")
-ApiAdded = namedtuple("ApiAdded", "sid loc")
-ApiExn = namedtuple("ApiExn", "sids exn loc")
-ApiMessage = namedtuple("ApiMessage", "sid level msg")
-ApiString = namedtuple("ApiString", "string")
 
-Pattern = type(re.compile("")) # LATER (3.7+): re.Pattern
+# Shared instances, compared by identity (most responses are acks)
+ACK, COMPLETED = ApiAck(), ApiCompleted()
+
+class ApiAdded:
+    __slots__ = ("sid", "loc")
+    def __init__(self, sid, loc):
+        self.sid, self.loc = sid, loc
+
+class ApiExn:
+    __slots__ = ("sids", "exn", "loc")
+    def __init__(self, sids, exn, loc):
+        self.sids, self.exn, self.loc = sids, exn, loc
+
+class ApiMessage:
+    __slots__ = ("sid", "level", "msg")
+    def __init__(self, sid, level, msg):
+        self.sid, self.level, self.msg = sid, level, msg
+
+class ApiString:
+    __slots__ = ("string",)
+    def __init__(self, string):
+        self.string = string
 
 class SerAPI():
     SERTOP_BIN = "sertop"
@@ -269,7 +359,20 @@ class SerAPI():
     # Whether to silently continue past unexpected output
     EXPECT_UNEXPECTED: bool = False
 
+    # Size of the buffer used to read sertop's output (goals can be large)
+    SERTOP_BUFSIZE = 1 << 20
+
+    # ``Ack`` and ``Completed`` answers don't need a full s-expression parser
+    ANSWER_STATUS_RE = re.compile(rb"[(]Answer [^()\s]+ (Ack|Completed)[)]\s*")
+    # Feedback that ``_deserialize_feedback`` ignores, and that therefore
+    # doesn't need to be parsed at all
+    IGNORED_FEEDBACK = (b'FileLoaded', b'ProcessingIn', b'Processed', b'AddedAxiom')
+    IGNORED_FEEDBACK_RE = re.compile(
+        rb"[(]Feedback[(][(]doc_id [0-9]+[)][(]span_id [0-9]+[)][(]route [0-9]+[)]"
+        rb"[(]contents ?[(]?(?:" + b"|".join(IGNORED_FEEDBACK) + rb")[ )]")
+
     MIN_PP_MARGIN = 20
+    PP_BATCH_BYTES = 1 << 12
     DEFAULT_PP_ARGS = {'pp_depth': 30, 'pp_margin': 55}
 
     @staticmethod
@@ -283,6 +386,7 @@ class SerAPI():
                  pp_args=DEFAULT_PP_ARGS):
         """Configure a ``sertop`` instance."""
         self.fpath = Path(fpath)
+        self._topfile = None
         self.args = [*args, *SerAPI.DEFAULT_ARGS, "--topfile={}".format(self.topfile)]
         self.sertop_bin = sertop_bin
         self.sertop = None
@@ -308,50 +412,55 @@ class SerAPI():
             finally:
                 self.sertop.wait()
 
+    # Extra characters allowed in identifiers, besides letters: Phonetic
+    # Extensions (1D00-1D7F), Phonetic Extensions Supplement (1D80-1DBF),
+    # Combining Diacritical Marks Supplement (1DC0-1DFF), underscore, and
+    # non-breaking space.
+    COQ_IDENT_START_EXTRA = "\u1D00-\u1D7F\u1D80-\u1DBF\u1DC0-\u1DFF\u005F\u00A0"
+
+    # Each entry is a set of Unicode categories plus a regexp of extra characters
     COQ_IDENT_START = (
-        'lu', # Letter, uppercase
-        'll', # Letter, lowercase
-        'lt', # Letter, titlecase
-        'lo', # Letter, others
-        'lm', # Letter, modifier
-        re.compile("""[
-           \u1D00-\u1D7F # Phonetic Extensions
-           \u1D80-\u1DBF # Phonetic Extensions Suppl
-           \u1DC0-\u1DFF # Combining Diacritical Marks Suppl
-           \u005F # Underscore
-           \u00A0 # Non breaking space
-         ]""", re.VERBOSE)
+        frozenset((
+            'Lu', # Letter, uppercase
+            'Ll', # Letter, lowercase
+            'Lt', # Letter, titlecase
+            'Lo', # Letter, others
+            'Lm', # Letter, modifier
+        )),
+        re.compile("[{}]".format(COQ_IDENT_START_EXTRA))
     )
 
     COQ_IDENT_PART = (
-        *COQ_IDENT_START,
-        'nd', # Number, decimal digits
-        'nl', # Number, letter
-        'no', # Number, other
-        re.compile("\u0027") # Single quote
+        COQ_IDENT_START[0] | frozenset((
+            'Nd', # Number, decimal digits
+            'Nl', # Number, letter
+            'No', # Number, other
+        )),
+        re.compile("[{}\u0027]".format(COQ_IDENT_START_EXTRA)) # Plus single quote
     )
 
     @staticmethod
     def valid_char(c, allowed):
-        for pattern in allowed:
-            if isinstance(pattern, str) and unicodedata.category(c).lower() == pattern:
-                return True
-            if isinstance(pattern, Pattern) and pattern.match(c):
-                return True
-        return False
+        categories, regexp = allowed
+        return unicodedata.category(c) in categories or regexp.match(c) is not None
 
     @classmethod
     def sub_chars(cls, chars, allowed):
-        return "".join(c if cls.valid_char(c, allowed) else "_" for c in chars)
+        # Check each distinct character only once
+        invalid = {ord(c): "_" for c in set(chars) if not cls.valid_char(c, allowed)}
+        return chars.translate(invalid)
 
     @property
     def topfile(self):
-        stem = self.fpath.stem
-        if stem in ("-", ""):
-            return "Top"
-        stem = (self.sub_chars(stem[0], self.COQ_IDENT_START) +
-                self.sub_chars(stem[1:], self.COQ_IDENT_PART))
-        return stem + self.fpath.suffix
+        if self._topfile is None:
+            stem = self.fpath.stem
+            if stem in ("-", ""):
+                self._topfile = "Top"
+            else:
+                stem = (self.sub_chars(stem[0], self.COQ_IDENT_START) +
+                        self.sub_chars(stem[1:], self.COQ_IDENT_PART))
+                self._topfile = stem + self.fpath.suffix
+        return self._topfile
 
     @staticmethod
     def resolve_sertop(sertop_bin):
@@ -367,9 +476,10 @@ class SerAPI():
         cmd = [self.resolve_sertop(self.sertop_bin), *self.args]
         debug(" ".join(quote(s) for s in cmd), '# ')
         # pylint: disable=consider-using-with
-        self.sertop = Popen(cmd, stdin=PIPE, stderr=sys.stderr, stdout=PIPE)
+        self.sertop = Popen(cmd, stdin=PIPE, stderr=sys.stderr, stdout=PIPE,
+                            bufsize=SerAPI.SERTOP_BUFSIZE)
 
-    def next_sexp(self):
+    def next_response(self):
         """Wait for the next sertop prompt, and return the output preceding it."""
         response = self.sertop.stdout.readline()
         if not response: # pragma: no cover
@@ -378,22 +488,67 @@ class SerAPI():
             raise UnexpectedError(MSG.format(self.last_response))
         debug(response, '<< ')
         self.last_response = response
+        return response
+
+    @staticmethod
+    def _load_response(response):
         try:
             return sx.load(response)
         except sx.ParseError: # pragma: no cover
             return response
 
-    def _send(self, sexp):
-        s = sx.dump([b'query%d' % self.next_qid, sexp])
+    def next_sexp(self):
+        """Like ``next_response``, but parse the output into an s-expression."""
+        return self._load_response(self.next_response())
+
+    def _responses(self):
+        """Read and deserialize sertop's output, one response at a time."""
+        while True:
+            response = self.next_response()
+            m = SerAPI.ANSWER_STATUS_RE.fullmatch(response)
+            if m: # Fast path for the most common answers
+                yield ACK if m.group(1) == b'Ack' else COMPLETED
+            elif SerAPI.IGNORED_FEEDBACK_RE.match(response):
+                pass
+            else:
+                yield from self._deserialize_response(self._load_response(response))
+
+    def _serialize_query(self, sexp):
+        """Serialize `sexp` into a newline-terminated query."""
+        buf = sx.dump([b'query%d' % self.next_qid, sexp])
+        buf += b'\n' # In place, to avoid copying the whole query
         self.next_qid += 1
+        return buf
+
+    def _write_query(self, s):
         debug(s, '>> ')
-        self.sertop.stdin.write(s + b'\n') # type: ignore
+        self.sertop.stdin.write(s) # type: ignore
         self.sertop.stdin.flush()
 
+    def _send(self, sexp):
+        self._write_query(self._serialize_query(sexp))
+
+    # Sertop's alists are short, so linear scans beat building a ``dict``.
+
+    @staticmethod
+    def _alist_item(alist, key):
+        """Like ``dict(alist)[key]``."""
+        for k, v in alist:
+            if k == key:
+                return v
+        raise KeyError(key)
+
+    @staticmethod
+    def _alist_get(alist, key, default=None):
+        """Like ``dict(alist).get(key, default)``."""
+        for k, v in alist:
+            if k == key:
+                return v
+        return default
+
     @staticmethod
     def _deserialize_loc(loc):
-        locd = dict(loc)
-        return int(locd[b'bp']), int(locd[b'ep'])
+        return int(SerAPI._alist_item(loc, b'bp')), int(SerAPI._alist_item(loc, b'ep'))
 
     @staticmethod
     def _deserialize_hyp(sexp):
@@ -405,18 +560,18 @@ class SerAPI():
 
     @staticmethod
     def _deserialize_goal(sexp):
-        name = dict(sexp[b'info'])[b'name']
+        name = SerAPI._alist_item(sexp[b'info'], b'name')
         hyps = [h for hs in reversed(sexp[b'hyp'])
                 for h in SerAPI._deserialize_hyp(hs)]
-        return Goal(dict(name).get(b'Id'), sexp[b'ty'], hyps)
+        return Goal(SerAPI._alist_get(name, b'Id'), sexp[b'ty'], hyps)
 
     @staticmethod
     def _deserialize_answer(sexp):
         tag = sexp_hd(sexp)
         if tag == b'Ack':
-            yield ApiAck()
+            yield ACK
         elif tag == b'Completed':
-            yield ApiCompleted()
+            yield COMPLETED
         elif tag == b'Added':
             yield ApiAdded(sexp[1], SerAPI._deserialize_loc(sexp[2]))
         elif tag == b'ObjList':
@@ -424,29 +579,29 @@ class SerAPI():
                 if tag == b'CoqString':
                     yield ApiString(sx.tostr(obj[0]))
                 elif tag == b'CoqExtGoal':
-                    gobj = dict(obj[0])
-                    for goal in gobj.get(b'goals', []):
+                    for goal in SerAPI._alist_get(obj[0], b'goals') or []:
                         yield SerAPI._deserialize_goal(dict(goal))
         elif tag == b'CoqExn':
-            exndata = dict(sexp[1])
-            opt_loc, opt_sids = exndata.get(b'loc'), exndata.get(b'stm_ids')
+            exndata = sexp[1]
+            opt_loc = SerAPI._alist_get(exndata, b'loc')
+            opt_sids = SerAPI._alist_get(exndata, b'stm_ids')
             loc = SerAPI._deserialize_loc(opt_loc[0]) if opt_loc else None
             sids = opt_sids[0] if opt_sids else None
-            yield ApiExn(sids, exndata[b'str'], loc)
+            yield ApiExn(sids, SerAPI._alist_item(exndata, b'str'), loc)
         else:
             raise UnexpectedError("Unexpected answer: {}".format(sexp))
 
     @staticmethod
     def _deserialize_feedback(sexp):
-        meta = dict(sexp)
-        contents = meta[b'contents']
+        contents = SerAPI._alist_item(sexp, b'contents')
         tag = sexp_hd(contents)
         if tag == b'Message':
-            mdata = dict(contents[1:])
+            mdata = contents[1:]
             # LATER: use the 'str' field directly instead of a Pp call
-            yield ApiMessage(meta[b'span_id'], mdata[b'level'], mdata[b'pp'])
-        elif tag in (b'FileLoaded', b'ProcessingIn',
-                     b'Processed', b'AddedAxiom'):
+            yield ApiMessage(SerAPI._alist_item(sexp, b'span_id'),
+                             SerAPI._alist_item(mdata, b'level'),
+                             SerAPI._alist_item(mdata, b'pp'))
+        elif tag in SerAPI.IGNORED_FEEDBACK:
             pass
         else:
             raise UnexpectedError("Unexpected feedback: {}".format(sexp))
@@ -462,7 +617,19 @@ class SerAPI():
 
     @staticmethod
     def highlight_substring(chunk, beg, end):
-        prefix, substring, suffix = chunk[:beg], chunk[beg:end], chunk[end:]
+        # Only 3 lines of context are shown on each side, so there is no need to
+        # split the whole chunk: 4 newlines back and 3 newlines forward suffice.
+        pbeg, send = beg, end
+        for _ in range(4):
+            pbeg = chunk.rfind(b"\n", 0, pbeg)
+            if pbeg == -1:
+                break
+        for _ in range(3):
+            send = chunk.find(b"\n", send) + 1
+            if send == 0:
+                send = len(chunk)
+                break
+        prefix, substring, suffix = chunk[pbeg + 1:beg], chunk[beg:end], chunk[end:send]
         prefix = b"\n".join(bytes(prefix).splitlines()[-3:])
         suffix = b"\n".join(bytes(suffix).splitlines()[:3])
         return b"%b>>>%b<<<%b" % (prefix, substring, suffix)
@@ -495,42 +662,72 @@ class SerAPI():
 
     def _collect_messages(self, typs: Tuple[type, ...], chunk, sid) -> Iterator[Any]:
         warn_on_exn = ApiExn not in typs
-        while True:
-            for response in self._deserialize_response(self.next_sexp()):
-                if isinstance(response, ApiAck):
-                    continue
-                if isinstance(response, ApiCompleted):
-                    return
-                if warn_on_exn and isinstance(response, ApiExn):
-                    if sid is None or response.sids is None or sid in response.sids:
-                        self._warn_on_exn(response, chunk)
-                if (not typs) or isinstance(response, typs): # type: ignore
-                    yield response
-
-    def _pprint(self, sexp, sid, kind, pp_depth, pp_margin):
-        if sexp is None:
-            return PrettyPrinted(sid, None)
-        if kind is not None:
-            sexp = [kind, sexp]
-        meta = [[b'sid', sid],
-                [b'pp',
-                 [[b'pp_format', b'PpStr'],
-                  [b'pp_depth', utf8(pp_depth)],
-                  [b'pp_margin', utf8(pp_margin)]]]]
-        self._send([b'Print', meta, sexp])
-        strings: List[ApiString] = list(self._collect_messages((ApiString,), None, sid))
-        if strings:
+        for response in self._responses():
+            if response is ACK:
+                continue
+            if response is COMPLETED:
+                return
+            if warn_on_exn and isinstance(response, ApiExn):
+                if sid is None or response.sids is None or sid in response.sids:
+                    self._warn_on_exn(response, chunk)
+            if (not typs) or isinstance(response, typs): # type: ignore
+                yield response
+
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def _pp_meta(pp_depth, pp_margin):
+        # Shared across calls: ``sx.dump`` does not mutate its input
+        return [b'pp',
+                [[b'pp_format', b'PpStr'],
+                 [b'pp_depth', utf8(pp_depth)],
+                 [b'pp_margin', utf8(pp_margin)]]]
+
+    def _read_pprinted(self, pending: List[PrettyPrinted]):
+        for pp in pending:
+            strings: List[ApiString] = list(self._collect_messages((ApiString,), None, pp.sid))
+            if not strings:
+                raise UnexpectedError("No string found in Print answer")
             assert len(strings) == 1
-            return PrettyPrinted(sid, strings[0].string)
-        raise UnexpectedError("No string found in Print answer")
+            pp.pp = strings[0].string
+        pending.clear()
 
-    def _pprint_message(self, msg: ApiMessage):
-        return self._pprint(msg.msg, msg.sid, b'CoqPp', **self.pp_args)
+    def _pprint_many(self, requests) -> List[PrettyPrinted]:
+        """Pretty-print a list of `requests` ``(sexp, sid, kind, pp_depth, pp_margin)``.
+
+        Sertop answers queries in order, so we send ``Print`` queries in
+        batches and read their answers afterwards, instead of waiting for each
+        answer in turn.  Batches are kept small enough to fit in the pipe's
+        buffer: otherwise we could block writing a query while sertop is itself
+        blocked writing answers that we haven't read.
+        """
+        pps, pending_bytes = [], 0
+        pending: List[PrettyPrinted] = []
+        for sexp, sid, kind, pp_depth, pp_margin in requests:
+            pp = PrettyPrinted(sid, None)
+            pps.append(pp)
+            if sexp is None:
+                continue
+            if kind is not None:
+                sexp = [kind, sexp]
+            meta = [[b'sid', sid], SerAPI._pp_meta(pp_depth, pp_margin)]
+            query = self._serialize_query([b'Print', meta, sexp])
+            if pending_bytes + len(query) > SerAPI.PP_BATCH_BYTES:
+                self._read_pprinted(pending)
+                pending_bytes = 0
+            self._write_query(query)
+            pending.append(pp)
+            pending_bytes += len(query)
+        self._read_pprinted(pending)
+        return pps
+
+    def _pprint_messages(self, msgs: List[ApiMessage]):
+        d, w = self.pp_args['pp_depth'], self.pp_args['pp_margin']
+        return self._pprint_many([(msg.msg, msg.sid, b'CoqPp', d, w) for msg in msgs])
 
     def _exec(self, sid, chunk):
         self._send([b'Exec', sid])
         messages: List[ApiMessage] = list(self._collect_messages((ApiMessage,), chunk, sid))
-        return [self._pprint_message(msg) for msg in messages]
+        return self._pprint_messages(messages)
 
     def _add(self, chunk):
         self._send([b'Add', [], sx.escape(chunk)])
@@ -541,34 +738,41 @@ class SerAPI():
             if isinstance(response, ApiAdded):
                 start, end = response.loc
                 if start != prev_end:
-                    spans.append((None, chunk[prev_end:start]))
-                spans.append((response.sid, chunk[start:end]))
+                    spans.append((None, prev_end, start))
+                spans.append((response.sid, start, end))
                 prev_end = end
             elif isinstance(response, ApiMessage):
                 messages.append(response)
         if prev_end != len(chunk):
-            spans.append((None, chunk[prev_end:]))
-        return spans, [self._pprint_message(msg) for msg in messages]
-
-    def _pprint_hyp(self, hyp, sid):
-        d = self.pp_args['pp_depth']
-        name_w = max(len(n) for n in hyp.names)
-        w = max(self.pp_args['pp_margin'] - name_w, SerAPI.MIN_PP_MARGIN)
-        body = self._pprint(hyp.body, sid, b'CoqExpr', d, w - 2).pp
-        htype = self._pprint(hyp.type, sid, b'CoqExpr', d, w - 3).pp
-        return Hypothesis(hyp.names, body, htype)
-
-    def _pprint_goal(self, goal, sid):
-        ccl = self._pprint(goal.conclusion, sid, b'CoqExpr', **self.pp_args).pp
-        hyps = [self._pprint_hyp(h, sid) for h in goal.hypotheses]
-        return Goal(sx.tostr(goal.name) if goal.name else None, ccl, hyps)
+            spans.append((None, prev_end, len(chunk)))
+        return spans, self._pprint_messages(messages)
+
+    def _pprint_goals(self, goals, sid):
+        d, margin = self.pp_args['pp_depth'], self.pp_args['pp_margin']
+        requests = []
+        for goal in goals:
+            requests.append((goal.conclusion, sid, b'CoqExpr', d, margin))
+            for hyp in goal.hypotheses:
+                name_w = max(len(n) for n in hyp.names)
+                w = max(margin - name_w, SerAPI.MIN_PP_MARGIN)
+                requests.append((hyp.body, sid, b'CoqExpr', d, w - 2))
+                requests.append((hyp.type, sid, b'CoqExpr', d, w - 3))
+        pps = [pp.pp for pp in self._pprint_many(requests)]
+        idx = 0
+        for goal in goals:
+            ccl, hyps = pps[idx], []
+            idx += 1
+            for h in goal.hypotheses:
+                hyps.append(Hypothesis(h.names, pps[idx], pps[idx + 1]))
+                idx += 2
+            yield Goal(sx.tostr(goal.name) if goal.name else None, ccl, hyps)
 
     def _goals(self, sid, chunk):
         # LATER Goals instead and CoqGoal and CoqConstr?
         # LATER We'd like to retrieve the formatted version directly
         self._send([b'Query', [[b'sid', sid]], b'EGoals'])
         goals: List[Goal] = list(self._collect_messages((Goal,), chunk, sid))
-        yield from (self._pprint_goal(g, sid) for g in goals)
+        yield from self._pprint_goals(goals, sid)
 
     def _warn_orphaned(self, chunk, message):
         err = "Orphaned message for sid {}:".format(message.sid)
@@ -586,8 +790,9 @@ class SerAPI():
         chunk = PosView(chunk)
         spans, messages = self._add(chunk)
         fragments, fragments_by_id = [], {}
-        for span_id, contents in spans:
-            contents = str(contents, encoding='utf-8')
+        mv = memoryview(chunk) # Not stored on `chunk`, to avoid a reference cycle
+        for span_id, start, end in spans:
+            contents = str(mv[start:end], encoding='utf-8')
             if span_id is None:
                 fragments.append(Text(contents))
             else:
@@ -610,7 +815,7 @@ class SerAPI():
         with self as api:
             return [api.run(chunk) for chunk in chunks]
 
-def annotate(chunks, sertop_args=()):
+def annotate(chunks, sertop_args=(), cache=None):
     r"""Annotate multiple `chunks` of Coq code.
 
     All fragments are executed in the same Coq instance, started with arguments
@@ -618,7 +823,21 @@ def annotate(chunks, sertop_args=()):
     `chunks`, but each element is a list of fragments: either ``Text``
     instances (whitespace and comments) or ``Sentence`` instances (code).
 
+    If `cache` is a dictionary, it is used to memoize results: annotating the
+    same `chunks` with the same `sertop_args` again returns the previous
+    results (which callers should then not mutate) without starting Coq.
+    Results are keyed on all chunks, since each chunk's output depends on the
+    ones before it.  Since Coq does not run on a cache hit, errors and warnings
+    are not reported again.
+
     >>> annotate(["Check 1."])
     [[Sentence(contents='Check 1.', messages=[Message(contents='1\n     : nat')], goals=[])]]
     """
-    return SerAPI(args=sertop_args).annotate(chunks)
+    if cache is None:
+        return SerAPI(args=sertop_args).annotate(chunks)
+    chunks = tuple(chunks)
+    key = (tuple(sertop_args), chunks)
+    annotated = cache.get(key)
+    if annotated is None:
+        annotated = cache[key] = SerAPI(args=sertop_args).annotate(chunks)
+    return annotated
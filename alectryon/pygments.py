@@ -20,7 +20,6 @@
 
 from typing import Dict
 
-import re
 import warnings
 from collections import deque
 from textwrap import indent
@@ -35,8 +34,6 @@ from pygments.filters import Filter, TokenMergeFilter, NameHighlightFilter
 from pygments.formatter import Formatter
 from pygments.lexers import get_lexer_by_name # pylint: disable=no-name-in-module
 
-from dominate.util import raw as dom_raw
-
 from .pygments_lexer import CoqLexer
 from .pygments_style import AlectryonStyle
 
@@ -103,17 +100,23 @@ def added_tokens(tokens, lang):
         lexer = get_lexer(lang)
         lexer.filters[:] = [f for f in lexer.filters if f not in added]
 
-WHITESPACE_RE = re.compile(r"\A(\s*)(.*?)(\s*)\Z", re.DOTALL)
-
-def _highlight(code, lexer, formatter):
+@lru_cache(maxsize=4096)
+def _highlight_cached(code, lexer, formatter, _filters):
     # See https://bitbucket.org/birkenfeld/pygments-main/issues/1522/ to
     # understand why we munge the STANDARD_TYPES dictionary
     with munged_dict(STANDARD_TYPES, {Name: '', Operator: ''}):
         # Pygments' HTML formatter adds an unconditional newline, so we pass it only
         # the code, and we restore the spaces after highlighting.
-        before, code, after = WHITESPACE_RE.match(code).groups()
+        beg = len(code) - len(code.lstrip())
+        end = max(beg, len(code.rstrip()))
+        before, code, after = code[:beg], code[beg:end], code[end:]
         return before, pygments.highlight(code, lexer, formatter).strip(), after
 
+def _highlight(code, lexer, formatter):
+    # Short snippets (hypotheses, goals) are often repeated, so we cache results.
+    # The lexer's filters are part of the key, since ``added_tokens`` changes them.
+    return _highlight_cached(code, lexer, formatter, tuple(lexer.filters))
+
 def validate_style(name):
     if isinstance(name, str):
         known_styles = sorted(pygments.styles.get_all_styles())
@@ -175,6 +178,8 @@ def highlight_html(code, lang, style=None):
     >>> str(highlight_html("Program Fixpoint a.", lang="coq"))
     '<span class="kn">Program Fixpoint</span> <span class="nf">a</span>.'
     """
+    # Imported here: ``dominate`` is slow to load and LaTeX output doesn't need it
+    from dominate.util import raw as dom_raw
     return dom_raw("".join(_highlight(code, get_lexer(lang), get_formatter("html", style))))
 
 PYGMENTS_LATEX_PREFIX = r"\begin{Verbatim}[commandchars=\\\{\}]" + "\n"
@@ -374,12 +374,24 @@ def strip_ids_and_props(obj, props):
                 so.props.pop(p, None) # type: ignore
     return obj
 
-LEADING_BLANKS_RE = re.compile(r'\A([ \t]*(?:\n|\Z))?(.*?)([ \t]*)\Z',
-                               flags=re.DOTALL)
-
 def isolate_blanks(txt):
-    """Split `txt` into blanks and an optional newline, text, and blanks."""
-    return LEADING_BLANKS_RE.match(txt).groups()
+    r"""Split `txt` into blanks and an optional newline, text, and blanks.
+
+    >>> isolate_blanks(" \n  a b \t")
+    (' \n', '  a b', ' \t')
+    >>> isolate_blanks("a ")
+    (None, 'a', ' ')
+    """
+    # Linear scans; a regexp with a lazy ``.*?`` backtracks on long blank runs
+    nblanks = len(txt) - len(txt.lstrip(" \t"))
+    if nblanks == len(txt):
+        return txt, "", ""
+    if txt[nblanks] == "\n":
+        blanks, rest = txt[:nblanks + 1], txt[nblanks + 1:]
+    else:
+        blanks, rest = None, txt
+    text = rest.rstrip(" \t")
+    return blanks, text, rest[len(text):]
 
 def group_whitespace_with_code(fragments):
     r"""Attach spaces to neighboring sentences.
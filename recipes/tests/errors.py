@@ -80,6 +80,27 @@ class core(unittest.TestCase):
         with self.assertRaisesRegex(TypeError, "Unexpected"):
             Backend(None)._gen_any(object())
 
+    def test_features(self):
+        from alectryon import core
+
+        class FakeSerAPI:
+            calls = 0
+            def __init__(self, args):
+                pass
+            def annotate(self, chunks):
+                FakeSerAPI.calls += 1
+                return [[core.Text(c)] for c in chunks]
+
+        cache = {}
+        with unittest.mock.patch.object(core, "SerAPI", FakeSerAPI):
+            chunks = ["Check 1.", "Check 2."]
+            annotated = core.annotate((c for c in chunks), cache=cache)
+            self.assertEqual(annotated, [[core.Text(c)] for c in chunks])
+            self.assertIs(core.annotate(chunks, cache=cache), annotated)
+            self.assertEqual(FakeSerAPI.calls, 1)
+            _ = core.annotate(chunks, ("-Q", "."), cache=cache)
+            self.assertEqual(FakeSerAPI.calls, 2)
+
 class serapi(unittest.TestCase):
     def test_warnings(self):
         from alectryon.core import SerAPI, View, PrettyPrinted